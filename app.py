@@ -1,13 +1,19 @@
 import logging
 import os
-from typing import AsyncGenerator, Optional
+from typing import AsyncGenerator, Callable, Iterator, Optional
 from flask import Flask, render_template, request, jsonify, session, Response
 import json
+import asyncio
+import queue
+import threading
+import time
 from ollama import AsyncClient
 import hypercorn
 from hypercorn.config import Config
 import httpx
 from pydantic import BaseModel
+import history
+from history import SearchError
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -42,6 +48,12 @@ class ImageAnalysis(BaseModel):
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "chatbot_secret_key")
 ollama_client = AsyncClient()
+history.init_history()
+history.start_embedding_worker()
+
+# Number of distinct models Ollama keeps loaded at once; /compare never runs
+# more models concurrently than this so they don't evict each other mid-stream.
+MAX_LOADED_MODELS = int(os.getenv("OLLAMA_MAX_LOADED_MODELS", "3"))
 
 # Error Handlers
 async def handle_ollama_error(error: Exception) -> tuple[dict, int]:
@@ -56,6 +68,12 @@ async def handle_ollama_error(error: Exception) -> tuple[dict, int]:
     logger.error(f"Ollama error: {str(error)}")
     return {"error": str(error)}, 500
 
+def persist_message(role: str, content: str, conversation: str) -> None:
+    try:
+        history.record_message(role, content, conversation)
+    except Exception as e:
+        logger.error(f"Message persistence error: {str(e)}")
+
 # Chat Mode Handlers
 async def handle_chat_mode(mode: str, model: str, message: str, stream: bool) -> dict | Response:
     if mode == 'generate':
@@ -115,11 +133,25 @@ async def handle_structured_mode(model: str, message: str) -> dict:
 
 async def handle_regular_chat(model: str, message: str, stream: bool) -> dict | Response:
     if stream:
-        return Response(generate_stream(message, model), mimetype='text/event-stream')
+        messages = list(session['messages'])
+        conversation = session.get('current_chat', 'default')
+        return Response(
+            sync_stream(lambda: chat_stream(AsyncClient(), model, messages, conversation)),
+            mimetype='text/event-stream'
+        )
 
     response = await ollama_client.chat(model=model, messages=session['messages'])
     return {'response': response['message']['content']}
 
+async def chat_stream(client: AsyncClient, model: str, messages: list,
+                      conversation: str) -> AsyncGenerator[str, None]:
+    reply = []
+    async for part in await client.chat(model=model, messages=messages, stream=True):
+        reply.append(part['message']['content'])
+        yield format_event({'response': part['message']['content']})
+    # Stored once the stream completes so the full answer is searchable
+    persist_message('assistant', ''.join(reply), conversation)
+
 def detect_schema(message: str) -> Optional[BaseModel]:
     schema_map = {
         'friends': FriendList,
@@ -154,6 +186,7 @@ async def chat():
             'role': 'user',
             'content': message
         })
+        persist_message('user', message, session.get('current_chat', 'default'))
 
         response = await handle_chat_mode(mode, model, message, stream)
 
@@ -164,6 +197,7 @@ async def chat():
             'role': 'assistant',
             'content': response['response']
         })
+        persist_message('assistant', response['response'], session.get('current_chat', 'default'))
 
         return jsonify({
             'response': response['response'],
@@ -216,7 +250,7 @@ async def generate_response():
 
         if stream:
             return Response(
-                generate_stream(prompt, model, options),
+                sync_stream(lambda: generate_stream(AsyncClient(), prompt, model, options)),
                 mimetype='text/event-stream'
             )
 
@@ -229,14 +263,175 @@ async def generate_response():
     except Exception as e:
         return await handle_ollama_error(e)
 
-async def generate_stream(prompt: str, model: str, options: dict) -> AsyncGenerator[str, None]:
-    async for part in ollama_client.generate(
+async def generate_stream(client: AsyncClient, prompt: str, model: str, options: dict) -> AsyncGenerator[str, None]:
+    async for part in await client.generate(
         model=model,
         prompt=prompt,
         stream=True,
         options=options
     ):
-        yield f"data: {json.dumps({'response': part['response']})}\n\n"
+        yield format_event({'response': part['response']})
+
+def format_event(event: dict, output_format: str = 'sse') -> str:
+    if output_format == 'sse':
+        return f"data: {json.dumps(event)}\n\n"
+    return json.dumps(event) + "\n"
+
+def sync_stream(make_stream: Callable[[], AsyncGenerator[str, None]],
+                output_format: str = 'sse') -> Iterator[str]:
+    """Iterate an async generator from Flask's synchronous response body.
+
+    The async view's event loop is gone by the time Werkzeug reads the body,
+    so the generator runs on its own loop in a background thread and hands
+    chunks over through a queue. Closing the response stops the generator.
+    If the generator fails, the stream ends with an `error` event so clients
+    can tell a failure from an empty reply.
+    """
+    chunks: queue.Queue = queue.Queue()
+    stopped = threading.Event()
+    finished = object()
+
+    async def pump():
+        stream = make_stream()
+        try:
+            async for chunk in stream:
+                if stopped.is_set():
+                    break
+                chunks.put(chunk)
+        except Exception as e:
+            logger.error(f"Streaming error: {str(e)}")
+            chunks.put(format_event({'error': str(e)}, output_format))
+        finally:
+            await stream.aclose()
+            chunks.put(finished)
+
+    threading.Thread(target=asyncio.run, args=(pump(),), daemon=True).start()
+    try:
+        while (chunk := chunks.get()) is not finished:
+            yield chunk
+    finally:
+        stopped.set()
+
+@app.route('/compare', methods=['POST'])
+async def compare_models():
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "JSON body is required"}), 400
+
+        prompt = data.get('prompt')
+        messages = data.get('messages')
+        models = data.get('models')
+        output_format = data.get('format', 'sse')
+        options = data.get('options', {
+            'temperature': 0.7,
+            'top_p': 0.9,
+            'top_k': 40,
+        })
+
+        if not prompt and not messages:
+            return jsonify({"error": "Prompt or messages is required"}), 400
+        if messages and not isinstance(messages, list):
+            return jsonify({"error": "Messages must be a list"}), 400
+        if prompt and not isinstance(prompt, str):
+            return jsonify({"error": "Prompt must be a string"}), 400
+        if (not isinstance(models, list) or not models
+                or not all(isinstance(m, str) and m for m in models)):
+            return jsonify({"error": "Models must be a non-empty list of model names"}), 400
+        if output_format not in ('sse', 'ndjson'):
+            return jsonify({"error": "Format must be 'sse' or 'ndjson'"}), 400
+
+        models = list(dict.fromkeys(models))
+        mimetype = 'text/event-stream' if output_format == 'sse' else 'application/x-ndjson'
+        return Response(
+            sync_stream(
+                lambda: compare_stream(AsyncClient(), models, prompt, messages, options, output_format),
+                output_format
+            ),
+            mimetype=mimetype
+        )
+    except Exception as e:
+        return await handle_ollama_error(e)
+
+async def compare_stream(client: AsyncClient, models: list[str], prompt: Optional[str],
+                         messages: Optional[list], options: dict,
+                         output_format: str) -> AsyncGenerator[str, None]:
+    events: asyncio.Queue = asyncio.Queue()
+    slots = asyncio.Semaphore(MAX_LOADED_MODELS)
+
+    # Start models that are already resident first so they don't wait on a load
+    try:
+        running = await client.ps()
+        resident = {model.model for model in running.models}
+    except Exception as e:
+        logger.error(f"Error getting process status: {str(e)}")
+        resident = set()
+    ordered = sorted(models, key=lambda m: m not in resident and f"{m}:latest" not in resident)
+
+    tasks = [
+        asyncio.create_task(stream_model(client, model, prompt, messages, options, slots, events))
+        for model in ordered
+    ]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            event = await events.get()
+            if event.get('done'):
+                remaining -= 1
+            yield format_event(event, output_format)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def stream_model(client: AsyncClient, model: str, prompt: Optional[str],
+                       messages: Optional[list], options: dict,
+                       slots: asyncio.Semaphore, events: asyncio.Queue) -> None:
+    # Latencies are measured from when the request was fanned out, so time
+    # spent waiting for a free model slot counts towards them
+    start = time.perf_counter()
+    async with slots:
+        started = time.perf_counter()
+        first_token = None
+        chunks = 0
+        final = None
+        try:
+            if messages:
+                stream = await client.chat(model=model, messages=messages, stream=True, options=options)
+            else:
+                stream = await client.generate(model=model, prompt=prompt, stream=True, options=options)
+
+            async for part in stream:
+                text = part['message']['content'] if messages else part['response']
+                if text:
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                    chunks += 1
+                    await events.put({'model': model, 'response': text})
+                if part.get('done'):
+                    final = part
+        except Exception as e:
+            logger.error(f"Compare error for {model}: {str(e)}")
+            await events.put({'model': model, 'done': True, 'error': str(e)})
+            return
+
+        end = time.perf_counter()
+        if final and final.get('eval_count') and final.get('eval_duration'):
+            tokens_per_second = final['eval_count'] / (final['eval_duration'] / 1e9)
+        elif first_token is not None and end > first_token:
+            tokens_per_second = chunks / (end - first_token)
+        else:
+            tokens_per_second = 0.0
+
+        await events.put({
+            'model': model,
+            'done': True,
+            'metrics': {
+                'queue_wait_ms': round((started - start) * 1000, 1),
+                'time_to_first_token_ms': round((first_token - start) * 1000, 1) if first_token else None,
+                'tokens_per_second': round(tokens_per_second, 2),
+                'total_latency_ms': round((end - start) * 1000, 1),
+            }
+        })
 
 @app.route('/analyze-comic', methods=['POST'])
 async def analyze_comic():
@@ -445,8 +640,39 @@ async def clear_history():
 
 @app.route('/messages', methods=['GET'])
 async def get_messages():
-    # For now, return an empty list since we're not storing messages
-    return jsonify([])
+    try:
+        conversation = request.args.get('conversation', session.get('current_chat', 'default'))
+        messages = history.list_messages(conversation)
+        return jsonify([message.to_dict() for message in messages])
+    except Exception as e:
+        logger.error(f"Message history error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/messages/search', methods=['GET'])
+async def search_messages():
+    try:
+        query = request.args.get('q', '')
+        mode = request.args.get('mode', 'fts')
+        filters = {
+            'role': request.args.get('role'),
+            'conversation': request.args.get('conversation'),
+            'since': request.args.get('since'),
+            'until': request.args.get('until'),
+            'limit': request.args.get('limit', 20, type=int),
+            'cursor': request.args.get('cursor'),
+        }
+
+        if mode == 'semantic':
+            results, next_cursor = await history.semantic_search(AsyncClient(), query, **filters)
+        else:
+            results, next_cursor = history.search_messages(query, **filters)
+
+        return jsonify({'results': results, 'next_cursor': next_cursor})
+    except SearchError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Message search error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/embed', methods=['POST'])
 async def generate_embedding():
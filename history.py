@@ -0,0 +1,501 @@
+import asyncio
+import base64
+import json
+import logging
+import math
+import os
+import queue
+import threading
+from datetime import datetime, timezone
+from typing import Optional, List, Tuple
+
+from ollama import AsyncClient
+from sqlalchemy import create_engine, text, select, bindparam, Integer, String, Text, DateTime, Float
+from sqlalchemy.orm import sessionmaker
+
+from models import Base, Message, MessageEmbedding
+
+logger = logging.getLogger(__name__)
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///chat_history.db")
+EMBED_MODEL = os.getenv("HISTORY_EMBED_MODEL", "")
+MAX_PAGE_SIZE = 100
+# Full-text results are ranked among the newest matches only, so queries for
+# very common terms cost the same as queries for rare ones
+SEARCH_CANDIDATES = int(os.getenv("HISTORY_SEARCH_CANDIDATES", "1000"))
+# Semantic search is an exact scan; larger result sets must be narrowed with filters
+SEMANTIC_MAX_ROWS = int(os.getenv("HISTORY_SEMANTIC_MAX_ROWS", "5000"))
+EMBED_BATCH_SIZE = 32
+EMBED_BACKFILL_INTERVAL = 60
+
+engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
+embedding_queue: queue.Queue = queue.Queue()
+
+# SQLite keeps an external-content FTS5 table in sync with `messages` through
+# triggers, so every insert is indexed as part of the same transaction. The
+# conversation is indexed too, so FTS5 intersects it with the search terms
+# instead of each match being checked against the filter.
+SQLITE_FTS_SETUP = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content, conversation, content='messages', content_rowid='id', tokenize='porter unicode61'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content, conversation)
+        VALUES (new.id, new.content, new.conversation);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content, conversation)
+        VALUES ('delete', old.id, old.content, old.conversation);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content, conversation ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content, conversation)
+        VALUES ('delete', old.id, old.content, old.conversation);
+        INSERT INTO messages_fts(rowid, content, conversation)
+        VALUES (new.id, new.content, new.conversation);
+    END""",
+]
+
+# Postgres stores the tsvector in a generated column so ranking never re-parses
+# message content; the column and its GIN index are maintained on every insert.
+POSTGRES_FTS_SETUP = [
+    """ALTER TABLE messages ADD COLUMN IF NOT EXISTS content_tsv tsvector
+        GENERATED ALWAYS AS (to_tsvector('english', content)) STORED""",
+    "CREATE INDEX IF NOT EXISTS ix_messages_content_tsv_gin ON messages USING GIN (content_tsv)",
+]
+
+# Result column types, so raw SQL rows come back like ORM attributes
+RESULT_TYPES = {
+    'id': Integer,
+    'role': String,
+    'content': Text,
+    'conversation': String,
+    'created_at': DateTime,
+    'score': Float,
+    'snippet': Text,
+    'vector': Text,
+    'norm': Float,
+}
+
+class SearchError(ValueError):
+    """Raised for invalid search parameters"""
+
+def init_history() -> None:
+    """Create the message tables and the full-text index for the configured database"""
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        if engine.dialect.name == 'sqlite':
+            conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+            exists = conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'"
+            ).first()
+            for statement in SQLITE_FTS_SETUP:
+                conn.exec_driver_sql(statement)
+            if not exists:
+                # Index rows stored before the FTS table existed
+                conn.exec_driver_sql("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+        elif engine.dialect.name == 'postgresql':
+            for statement in POSTGRES_FTS_SETUP:
+                conn.exec_driver_sql(statement)
+
+def record_message(role: str, content: str, conversation: str = 'default') -> Message:
+    """Persist a chat message; the full-text index is updated in the same transaction"""
+    with SessionLocal.begin() as db:
+        message = Message(role=role, content=content, conversation=conversation)
+        db.add(message)
+    queue_embedding(message.id)
+    return message
+
+def list_messages(conversation: str = 'default', limit: int = MAX_PAGE_SIZE) -> List[Message]:
+    """Return the most recent messages of a conversation, oldest first"""
+    with SessionLocal() as db:
+        rows = db.scalars(
+            select(Message)
+            .where(Message.conversation == conversation)
+            .order_by(Message.id.desc())
+            .limit(limit)
+        ).all()
+    return list(reversed(rows))
+
+# Embeddings
+def queue_embedding(message_id: int) -> None:
+    """Hand a message to the background embedding worker"""
+    if EMBED_MODEL:
+        embedding_queue.put(message_id)
+
+def start_embedding_worker() -> None:
+    """Embed new messages off the request path when HISTORY_EMBED_MODEL is configured"""
+    if EMBED_MODEL:
+        threading.Thread(target=run_embedding_worker, name='history-embedder', daemon=True).start()
+
+def run_embedding_worker() -> None:
+    """Embed queued messages in batches; when idle, backfill messages missing an embedding.
+
+    Backfill sweeps from the newest message down, so messages that keep
+    failing are skipped for the rest of the sweep and retried by the next one.
+    """
+    loop = asyncio.new_event_loop()
+    client = AsyncClient()
+    before, sweeping = None, True
+    while True:
+        batch = next_embedding_batch(0 if sweeping else EMBED_BACKFILL_INTERVAL)
+        if batch:
+            loop.run_until_complete(embed_batch(client, batch))
+        else:
+            before, sweeping = loop.run_until_complete(backfill_step(client, before))
+
+async def backfill_step(client, before: Optional[int]) -> Tuple[Optional[int], bool]:
+    """Embed the next batch of messages missing an embedding below `before`.
+
+    Returns the position to continue from and whether to continue right away.
+    A finished sweep restarts from the newest message; a batch where nothing
+    could be embedded (e.g. Ollama is down) pauses the sweep.
+    """
+    batch = missing_embeddings(EMBED_BATCH_SIZE, before)
+    if not batch:
+        return None, False
+    embedded = await embed_batch(client, batch)
+    return min(batch), embedded > 0
+
+async def embed_batch(client, message_ids: List[int]) -> int:
+    """Embed a batch, falling back to one message at a time if the batch fails.
+
+    Returns the number of messages embedded.
+    """
+    try:
+        await embed_messages(client, message_ids)
+        return len(message_ids)
+    except Exception as e:
+        logger.error(f"Embedding error: {str(e)}")
+    embedded = 0
+    for message_id in message_ids:
+        try:
+            await embed_messages(client, [message_id])
+            embedded += 1
+        except Exception as e:
+            logger.error(f"Embedding error for message {message_id}: {str(e)}")
+    return embedded
+
+def next_embedding_batch(timeout: float) -> List[int]:
+    try:
+        batch = [embedding_queue.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    while len(batch) < EMBED_BATCH_SIZE:
+        try:
+            batch.append(embedding_queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+def missing_embeddings(limit: int, before: Optional[int] = None) -> List[int]:
+    """Ids of the newest messages below `before` without an embedding for the configured model"""
+    below = "AND m.id < :before" if before is not None else ""
+    with engine.connect() as conn:
+        return list(conn.execute(text(f"""
+            SELECT m.id FROM messages m
+            LEFT JOIN message_embeddings e ON e.message_id = m.id AND e.model = :model
+            WHERE e.message_id IS NULL {below}
+            ORDER BY m.id DESC
+            LIMIT :limit
+        """), {'model': EMBED_MODEL, 'limit': limit, 'before': before}).scalars())
+
+async def embed_messages(client, message_ids: List[int]) -> None:
+    """Embed a batch of messages in a single Ollama call and store the vectors"""
+    with SessionLocal() as db:
+        messages = db.scalars(select(Message).where(Message.id.in_(message_ids))).all()
+    if not messages:
+        return
+    response = await client.embed(model=EMBED_MODEL, input=[m.content for m in messages])
+    with SessionLocal.begin() as db:
+        for message, vector in zip(messages, response['embeddings']):
+            db.merge(MessageEmbedding(
+                message_id=message.id,
+                model=EMBED_MODEL,
+                vector=json.dumps(vector),
+                norm=math.sqrt(sum(v * v for v in vector))
+            ))
+
+# Search
+def encode_cursor(*values) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor: str, *types) -> tuple:
+    """Decode a cursor into values of the given types"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(values) != len(types):
+            raise ValueError(cursor)
+        return tuple(cast(value) for cast, value in zip(types, values))
+    except (ValueError, TypeError) as e:
+        raise SearchError(f"Invalid cursor: {cursor}") from e
+
+def parse_date(value: Optional[str]) -> Optional[datetime]:
+    """Parse an ISO 8601 timestamp into naive UTC, matching stored created_at values"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError as e:
+        raise SearchError(f"Invalid date: {value}") from e
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def build_filters(role: Optional[str], conversation: Optional[str],
+                  since: Optional[datetime], until: Optional[datetime]) -> Tuple[List[str], dict]:
+    clauses, params = [], {}
+    if role:
+        clauses.append("m.role = :role")
+        params['role'] = role
+    if conversation:
+        clauses.append("m.conversation = :conversation")
+        params['conversation'] = conversation
+    if since:
+        clauses.append("m.created_at >= :since")
+        params['since'] = since
+    if until:
+        clauses.append("m.created_at < :until")
+        params['until'] = until
+    return clauses, params
+
+def typed_query(sql: str, params: dict, columns: List[str]):
+    """Bind date filters and result columns through SQLAlchemy types"""
+    dates = [bindparam(name, type_=DateTime) for name in ('since', 'until') if name in params]
+    return text(sql).bindparams(*dates).columns(**{name: RESULT_TYPES[name] for name in columns})
+
+def fts5_phrase(value: str) -> str:
+    return '"{}"'.format(value.replace('"', '""'))
+
+def fts5_query(query: str, conversation: Optional[str] = None) -> str:
+    """Build an FTS5 query matching every term in the content column.
+
+    Each term is quoted so user input cannot break FTS5 query syntax. The
+    conversation phrase narrows the match inside FTS5; the exact comparison on
+    messages.conversation still applies afterwards.
+    """
+    match = '{content} : (' + ' '.join(fts5_phrase(term) for term in query.split()) + ')'
+    if conversation and any(ch.isalnum() for ch in conversation):
+        match += ' AND {conversation} : ' + fts5_phrase(conversation)
+    return match
+
+def search_messages(query: str, role: Optional[str] = None, conversation: Optional[str] = None,
+                    since: Optional[str] = None, until: Optional[str] = None,
+                    limit: int = 20, cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+    """Ranked full-text search with cursor pagination.
+
+    Matches are ranked among the newest SEARCH_CANDIDATES of them, and only
+    that bounded set is scored. The cursor holds the newest message id seen by
+    the first page and an offset into the ranking; bm25 scores move as the
+    corpus grows, so an offset into the pinned candidate set is used rather
+    than a (score, id) keyset.
+    """
+    if not query.strip():
+        raise SearchError("Query is required")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    clauses, params = build_filters(role, conversation, parse_date(since), parse_date(until))
+    params['limit'] = limit + 1
+    params['offset'] = 0
+    params['candidates'] = SEARCH_CANDIDATES
+
+    # Id bounds go on the FTS5 rowid so the match scan itself is limited
+    id_column = "messages_fts.rowid" if engine.dialect.name == 'sqlite' else "m.id"
+
+    with engine.connect() as conn:
+        if cursor:
+            params['offset'], params['snapshot'] = decode_cursor(cursor, int, int)
+        else:
+            params['snapshot'] = conn.execute(text("SELECT coalesce(max(id), 0) FROM messages")).scalar()
+        clauses.append(f"{id_column} <= :snapshot")
+
+        if role and conn.execute(
+            text("SELECT 1 FROM messages WHERE role = :role LIMIT 1"), {'role': role}
+        ).first() is None:
+            # Otherwise every match would be scanned only to be filtered out
+            return [], None
+
+        if 'since' in params or 'until' in params:
+            first_id, last_id = date_id_range(conn, params)
+            if first_id is None or last_id is None:
+                return [], None
+            params['first_id'], params['last_id'] = first_id, last_id
+            clauses.append(f"{id_column} BETWEEN :first_id AND :last_id")
+
+        if engine.dialect.name == 'sqlite':
+            # bm25() is lower-is-better, so rows are ordered ascending
+            params['query'] = fts5_query(query, conversation)
+            direction = "ASC"
+            # The conversation column is weighted 0 so it does not affect ranking
+            candidates = f"""
+                SELECT m.id AS id, bm25(messages_fts, 1.0, 0.0) AS score
+                FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+                WHERE messages_fts MATCH :query AND {' AND '.join(clauses)}
+                ORDER BY messages_fts.rowid DESC
+                LIMIT :candidates
+            """
+            # Snippets are filled in by sqlite_snippets()
+            snippet = "NULL"
+        elif engine.dialect.name == 'postgresql':
+            params['query'] = query
+            direction = "DESC"
+            candidates = f"""
+                SELECT c.id, ts_rank_cd(m.content_tsv, websearch_to_tsquery('english', :query)) AS score
+                FROM (
+                    SELECT m.id FROM messages m
+                    WHERE m.content_tsv @@ websearch_to_tsquery('english', :query)
+                      AND {' AND '.join(clauses)}
+                    ORDER BY m.id DESC
+                    LIMIT :candidates
+                ) c JOIN messages m ON m.id = c.id
+            """
+            snippet = ("ts_headline('english', m.content, websearch_to_tsquery('english', :query), "
+                       "'StartSel=<mark>, StopSel=</mark>, MaxFragments=1')")
+        else:
+            raise SearchError(f"Full-text search is not supported on {engine.dialect.name}")
+
+        # Snippets are only built for the rows on the returned page
+        sql = f"""
+            WITH candidates AS MATERIALIZED ({candidates}),
+            page AS (
+                SELECT id, score FROM candidates
+                ORDER BY score {direction}, id ASC
+                LIMIT :limit OFFSET :offset
+            )
+            SELECT m.id, m.role, m.content, m.conversation, m.created_at,
+                   page.score, {snippet} AS snippet
+            FROM page JOIN messages m ON m.id = page.id
+            ORDER BY page.score {direction}, page.id ASC
+        """
+        rows = conn.execute(
+            typed_query(sql, params, ['id', 'role', 'content', 'conversation', 'created_at', 'score', 'snippet']),
+            params
+        ).mappings().all()
+        rows = [dict(row) for row in rows]
+        if engine.dialect.name == 'sqlite' and rows:
+            snippets = sqlite_snippets(conn, params['query'], [row['id'] for row in rows])
+            for row in rows:
+                row['snippet'] = snippets.get(row['id'])
+    rows, more = paginate(rows, limit)
+    next_cursor = encode_cursor(params['offset'] + limit, params['snapshot']) if more else None
+    return rows, next_cursor
+
+def date_id_range(conn, params: dict) -> Tuple[Optional[int], Optional[int]]:
+    """Translate since/until into the range of message ids they cover.
+
+    Ids and created_at both grow with insertion order, so a date range is an
+    id range that the full-text scan can be limited to. The bounds are read
+    through the created_at index. The exact date filter
+    still applies on top. Returns None for a bound with no messages in range.
+    """
+    first_id, last_id = 0, params['snapshot']
+    if 'since' in params:
+        first_id = conn.execute(
+            text("SELECT id FROM messages WHERE created_at >= :since ORDER BY created_at, id LIMIT 1")
+            .bindparams(bindparam('since', type_=DateTime)),
+            {'since': params['since']}
+        ).scalar()
+    if 'until' in params:
+        last_id = conn.execute(
+            text("SELECT id FROM messages WHERE created_at < :until "
+                 "ORDER BY created_at DESC, id DESC LIMIT 1")
+            .bindparams(bindparam('until', type_=DateTime)),
+            {'until': params['until']}
+        ).scalar()
+    return first_id, last_id
+
+def sqlite_snippets(conn, match: str, message_ids: List[int]) -> dict:
+    """Build FTS5 snippets for one page of results.
+
+    Joining each page row back to `messages_fts` re-runs the MATCH per row.
+    A single scan over the page's rowid range is much cheaper. The unary `+`
+    keeps the id list a plain filter, so FTS5 does not take it as a rowid
+    constraint.
+    """
+    sql = text("""
+        SELECT rowid AS id, snippet(messages_fts, 0, '<mark>', '</mark>', '...', 16) AS snippet
+        FROM messages_fts
+        WHERE messages_fts MATCH :query AND rowid BETWEEN :first AND :last AND +rowid IN :ids
+    """).bindparams(bindparam('ids', expanding=True))
+    rows = conn.execute(sql, {
+        'query': match, 'first': min(message_ids), 'last': max(message_ids), 'ids': message_ids
+    })
+    return {row.id: row.snippet for row in rows}
+
+async def semantic_search(client, query: str, role: Optional[str] = None,
+                          conversation: Optional[str] = None, since: Optional[str] = None,
+                          until: Optional[str] = None, limit: int = 20,
+                          cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+    """Rank messages by cosine similarity to the query embedding.
+
+    Similarity scores do not change as messages are added, so pages use a
+    (score, id) keyset. This is an exact scan over the stored embeddings, so
+    it is refused when the filters leave more than SEMANTIC_MAX_ROWS messages
+    to compare.
+    """
+    if not EMBED_MODEL:
+        raise SearchError("Semantic search requires HISTORY_EMBED_MODEL to be set")
+    if not query.strip():
+        raise SearchError("Query is required")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    clauses, params = build_filters(role, conversation, parse_date(since), parse_date(until))
+    clauses.append("e.model = :model")
+    params['model'] = EMBED_MODEL
+    params['max_rows'] = SEMANTIC_MAX_ROWS
+    clauses.append("m.id <= :snapshot")
+    where = ' AND '.join(clauses)
+
+    with engine.connect() as conn:
+        if cursor:
+            cursor_score, cursor_id, params['snapshot'] = decode_cursor(cursor, float, int, int)
+        else:
+            params['snapshot'] = conn.execute(text("SELECT coalesce(max(id), 0) FROM messages")).scalar()
+        count_sql = f"""
+            SELECT count(*) FROM (
+                SELECT 1 FROM messages m JOIN message_embeddings e ON e.message_id = m.id
+                WHERE {where} LIMIT :max_rows + 1
+            ) AS bounded
+        """
+        if conn.execute(typed_query(count_sql, params, []), params).scalar() > SEMANTIC_MAX_ROWS:
+            raise SearchError(
+                f"Semantic search is limited to {SEMANTIC_MAX_ROWS} messages; "
+                "narrow it with conversation, role, since or until"
+            )
+
+    response = await client.embed(model=EMBED_MODEL, input=query)
+    query_vector = response['embeddings'][0]
+    query_norm = math.sqrt(sum(v * v for v in query_vector)) or 1.0
+
+    sql = f"""
+        SELECT m.id, m.role, m.content, m.conversation, m.created_at, e.vector, e.norm
+        FROM messages m JOIN message_embeddings e ON e.message_id = m.id
+        WHERE {where}
+    """
+    with engine.connect() as conn:
+        rows = conn.execute(
+            typed_query(sql, params, ['id', 'role', 'content', 'conversation', 'created_at', 'vector', 'norm']),
+            params
+        ).mappings().all()
+
+    results = []
+    for row in rows:
+        vector = json.loads(row['vector'])
+        dot = sum(a * b for a, b in zip(query_vector, vector))
+        result = {key: row[key] for key in ('id', 'role', 'content', 'conversation', 'created_at')}
+        result['score'] = dot / (query_norm * (row['norm'] or 1.0))
+        results.append(result)
+    results.sort(key=lambda r: (-r['score'], r['id']))
+
+    if cursor:
+        results = [r for r in results
+                   if r['score'] < cursor_score or (r['score'] == cursor_score and r['id'] > cursor_id)]
+    rows, more = paginate(results[:limit + 1], limit)
+    next_cursor = encode_cursor(rows[-1]['score'], rows[-1]['id'], params['snapshot']) if more else None
+    return rows, next_cursor
+
+def paginate(rows: List[dict], limit: int) -> Tuple[List[dict], bool]:
+    """Trim the look-ahead row and report whether another page follows"""
+    more = len(rows) > limit
+    rows = rows[:limit]
+    for row in rows:
+        row['created_at'] = row['created_at'].isoformat()
+    return rows, more
@@ -3,7 +3,7 @@ from datetime import datetime
 from typing import Optional, Any, List, Literal
 from pydantic import BaseModel
 from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy import Column, Integer, String, Text, DateTime
+from sqlalchemy import Column, Integer, String, Text, DateTime, Float, ForeignKey, Index
 
 # Database Models
 class Base(DeclarativeBase):
@@ -14,16 +14,30 @@ class Message(Base):
     id = Column(Integer, primary_key=True)
     role = Column(String(10), nullable=False)
     content = Column(Text, nullable=False) 
-    created_at = Column(DateTime, default=datetime.utcnow)
+    conversation = Column(String(100), nullable=False, default='default')
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        Index('ix_messages_conversation_created_at', 'conversation', 'created_at'),
+        Index('ix_messages_role_created_at', 'role', 'created_at'),
+    )
 
     def to_dict(self) -> dict:
         return {
             'id': self.id,
             'role': self.role,
             'content': self.content,
+            'conversation': self.conversation,
             'created_at': self.created_at.isoformat()
         }
 
+class MessageEmbedding(Base):
+    __tablename__ = 'message_embeddings'
+    message_id = Column(Integer, ForeignKey('messages.id', ondelete='CASCADE'), primary_key=True)
+    model = Column(String(100), nullable=False)
+    vector = Column(Text, nullable=False)  # JSON-encoded list of floats
+    norm = Column(Float, nullable=False)
+
 # Response Models
 class ChatResponse(BaseModel):
     content: str
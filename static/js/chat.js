@@ -473,7 +473,13 @@ createModelSubmit.addEventListener('click', async () => {
                     for (const line of lines) {
                         if (line.startsWith('data: ')) {
                             const data = JSON.parse(line.slice(6));
-                            currentMessage += data.response;
+                            if (data.error) {
+                                console.error('Stream error:', data.error);
+                                currentMessage += currentMessage ? '\n\n' : '';
+                                currentMessage += 'Sorry, I encountered an error. Please try again.';
+                            } else {
+                                currentMessage += data.response;
+                            }
                             textContent.textContent = currentMessage;
                         }
                     }
@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# Keep the test run away from the on-disk chat history database
+os.environ.setdefault(
+    "DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'chat_history.db')}"
+)
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+import app as chat_app
+
+DELAYS = {'fast': 0.05, 'slow': 0.2}
+
+class FakeClient:
+    """Stand-in for ollama.AsyncClient that streams a few tokens per model"""
+
+    async def ps(self):
+        class Running:
+            models = []
+        return Running()
+
+    async def generate(self, model, prompt, stream, options):
+        async def parts():
+            if model == 'broken':
+                raise RuntimeError('model not found')
+            for i in range(3):
+                await asyncio.sleep(DELAYS[model])
+                yield {'response': f'{model}-{i}', 'done': False}
+            yield {'response': '', 'done': True, 'eval_count': 3, 'eval_duration': 300_000_000}
+        return parts()
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(chat_app, 'AsyncClient', FakeClient)
+    return chat_app.app.test_client()
+
+def read_events(response):
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines() if line]
+
+def test_compare_streams_all_models_concurrently(client):
+    start = time.perf_counter()
+    response = client.post('/compare', json={
+        'prompt': 'hi', 'models': ['fast', 'slow', 'broken'], 'format': 'ndjson'
+    })
+    events = read_events(response)
+    elapsed = time.perf_counter() - start
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    for model in ('fast', 'slow'):
+        tokens = [e['response'] for e in events if e['model'] == model and 'response' in e]
+        assert tokens == [f'{model}-0', f'{model}-1', f'{model}-2']
+        done = [e for e in events if e['model'] == model and e.get('done')]
+        assert set(done[0]['metrics']) == {
+            'queue_wait_ms', 'time_to_first_token_ms', 'tokens_per_second', 'total_latency_ms'
+        }
+        assert done[0]['metrics']['tokens_per_second'] == 10.0
+    assert {'model': 'broken', 'done': True, 'error': 'model not found'} in events
+    # Bounded by the slowest model (0.6s), not the sum of all of them (0.75s)
+    assert elapsed < 0.7
+
+def test_compare_counts_slot_wait_in_latency(client, monkeypatch):
+    monkeypatch.setattr(chat_app, 'MAX_LOADED_MODELS', 1)
+    response = client.post('/compare', json={
+        'prompt': 'hi', 'models': ['slow', 'fast'], 'format': 'ndjson'
+    })
+    metrics = {e['model']: e['metrics'] for e in read_events(response) if e.get('done')}
+    waited = metrics['fast']
+    assert waited['queue_wait_ms'] >= 500
+    assert waited['total_latency_ms'] >= waited['queue_wait_ms'] + 150
+
+def test_compare_sse_format(client):
+    response = client.post('/compare', json={'prompt': 'hi', 'models': ['fast']})
+    body = response.get_data(as_text=True)
+    assert response.mimetype == 'text/event-stream'
+    assert body.startswith('data: {"model": "fast", "response": "fast-0"}\n\n')
+
+@pytest.mark.parametrize('payload', [
+    {'prompt': 'hi', 'models': 'llama2'},
+    {'prompt': 'hi', 'models': []},
+    {'prompt': 'hi', 'models': ['llama2', 3]},
+    {'prompt': 'hi'},
+    {'models': ['llama2']},
+    {'prompt': 'hi', 'models': ['llama2'], 'format': 'xml'},
+])
+def test_compare_rejects_invalid_requests(client, payload):
+    assert client.post('/compare', json=payload).status_code == 400
+
+def test_compare_requires_json_body(client):
+    assert client.post('/compare', data='not json').status_code == 400
+
+def test_failed_stream_ends_with_error_event(monkeypatch):
+    class FailingClient:
+        async def generate(self, model, prompt, stream, options):
+            async def parts():
+                yield {'response': 'partial'}
+                raise ConnectionError('Ollama went away')
+            return parts()
+
+    monkeypatch.setattr(chat_app, 'AsyncClient', FailingClient)
+    response = chat_app.app.test_client().post('/generate', json={'prompt': 'hi'})
+    assert response.get_data(as_text=True) == (
+        'data: {"response": "partial"}\n\n'
+        'data: {"error": "Ollama went away"}\n\n'
+    )
+
+def test_failed_ndjson_stream_ends_with_error_line():
+    async def failing():
+        yield '{"model": "a", "response": "x"}\n'
+        raise RuntimeError('boom')
+
+    assert list(chat_app.sync_stream(failing, 'ndjson')) == [
+        '{"model": "a", "response": "x"}\n',
+        '{"error": "boom"}\n',
+    ]
@@ -0,0 +1,239 @@
+from datetime import datetime, timedelta, timezone
+
+import asyncio
+
+import pytest
+
+import history
+from models import Message, MessageEmbedding
+
+@pytest.fixture(autouse=True)
+def empty_history():
+    history.init_history()
+    with history.SessionLocal.begin() as db:
+        db.query(MessageEmbedding).delete()
+        db.query(Message).delete()
+
+class FakeEmbedClient:
+    """Stand-in for ollama.AsyncClient that embeds text by counting keywords.
+
+    Like httpx's connection pool, it is bound to the first event loop it is
+    used on and fails on any other.
+    """
+
+    def __init__(self):
+        self.loop = None
+
+    async def embed(self, model, input):
+        loop = asyncio.get_running_loop()
+        if self.loop not in (None, loop):
+            raise RuntimeError('Event loop is closed')
+        self.loop = loop
+        texts = [input] if isinstance(input, str) else input
+        return {'embeddings': [[t.count('cat'), t.count('dog'), 1.0] for t in texts]}
+
+@pytest.fixture
+def semantic(monkeypatch):
+    monkeypatch.setattr(history, 'EMBED_MODEL', 'fake-embed')
+    yield
+    while not history.embedding_queue.empty():
+        history.embedding_queue.get_nowait()
+
+def embed_all():
+    with history.SessionLocal() as db:
+        ids = [m.id for m in db.query(Message)]
+    asyncio.run(history.embed_messages(FakeEmbedClient(), ids))
+
+def test_search_ranks_and_filters():
+    history.record_message('user', 'how do I read a file in python', 'c1')
+    history.record_message('assistant', 'python python: use open() to read files', 'c1')
+    history.record_message('assistant', 'python lists are mutable', 'c2')
+
+    results, _ = history.search_messages('python read')
+    assert [r['content'] for r in results][0] == 'python python: use open() to read files'
+    assert len(results) == 2
+    assert '<mark>' in results[0]['snippet']
+
+    results, _ = history.search_messages('python', role='assistant', conversation='c2')
+    assert [r['content'] for r in results] == ['python lists are mutable']
+
+def test_search_conversation_filter_is_exact():
+    history.record_message('user', 'python tips', 'chat my name')
+    history.record_message('user', 'python tricks', 'chat my name extra')
+    history.record_message('user', 'python notes', '---')
+    history.record_message('user', 'nothing relevant', 'python')
+
+    results, _ = history.search_messages('python', conversation='chat my name')
+    assert [r['content'] for r in results] == ['python tips']
+    results, _ = history.search_messages('python', conversation='---')
+    assert [r['content'] for r in results] == ['python notes']
+    # Search terms only match message content, not conversation names
+    results, _ = history.search_messages('python')
+    assert 'nothing relevant' not in [r['content'] for r in results]
+
+def test_search_pages_cover_every_match_once():
+    for i in range(25):
+        history.record_message('user', 'python ' * (i % 4 + 1) + f'item{i}')
+
+    seen, cursor = [], None
+    while True:
+        results, cursor = history.search_messages('python', limit=10, cursor=cursor)
+        seen += [r['id'] for r in results]
+        # Later inserts must not leak into or reshuffle an ongoing search
+        history.record_message('user', 'python arrived later')
+        if not cursor:
+            break
+    assert len(seen) == 25
+    assert len(set(seen)) == 25
+
+def test_search_timestamps_match_message_listing():
+    message = history.record_message('user', 'python timestamps')
+    results, _ = history.search_messages('timestamps')
+    assert results[0]['created_at'] == message.to_dict()['created_at']
+
+def test_search_converts_aware_dates_to_utc():
+    history.record_message('user', 'python dates')
+    now = datetime.now(timezone.utc)
+    ahead = timezone(timedelta(hours=5))
+
+    # Same instant as a minute ago, written with a +05:00 offset
+    since = (now - timedelta(minutes=1)).astimezone(ahead).isoformat()
+    assert len(history.search_messages('dates', since=since)[0]) == 1
+    until = (now - timedelta(minutes=1)).astimezone(ahead).isoformat()
+    assert history.search_messages('dates', until=until)[0] == []
+
+def test_search_date_window_selects_exact_messages():
+    start = datetime(2026, 1, 1)
+    with history.SessionLocal.begin() as db:
+        for day in range(10):
+            db.add(Message(role='user', content=f'python day{day}', conversation='default',
+                           created_at=start + timedelta(days=day)))
+
+    results, _ = history.search_messages('python', since='2026-01-03T00:00:00', until='2026-01-06T00:00:00')
+    assert sorted(r['content'] for r in results) == ['python day2', 'python day3', 'python day4']
+    assert history.search_messages('python', since='2027-01-01T00:00:00') == ([], None)
+    assert history.search_messages('python', until='2025-01-01T00:00:00') == ([], None)
+
+@pytest.mark.parametrize('kwargs', [
+    {'query': ' '},
+    {'query': 'python', 'since': 'yesterday'},
+    {'query': 'python', 'cursor': 'not-a-cursor'},
+])
+def test_search_rejects_invalid_parameters(kwargs):
+    with pytest.raises(history.SearchError):
+        history.search_messages(**kwargs)
+
+def test_streamed_chat_reply_is_stored(monkeypatch):
+    import app as chat_app
+
+    class FakeClient:
+        async def chat(self, model, messages, stream):
+            async def parts():
+                for text in ('Use ', 'open()'):
+                    yield {'message': {'role': 'assistant', 'content': text}}
+            return parts()
+
+    monkeypatch.setattr(chat_app, 'AsyncClient', FakeClient)
+    response = chat_app.app.test_client().post('/chat', json={'message': 'read a file?'})
+    assert response.get_data(as_text=True).count('data: ') == 2
+
+    stored = [(m.role, m.content) for m in history.list_messages()]
+    assert stored == [('user', 'read a file?'), ('assistant', 'Use open()')]
+
+def test_semantic_search_endpoint_survives_repeated_requests(semantic, monkeypatch):
+    import app as chat_app
+
+    history.record_message('user', 'cat cat')
+    embed_all()
+    # A client shared across requests would be reused on a closed event loop
+    monkeypatch.setattr(chat_app, 'ollama_client', FakeEmbedClient())
+    monkeypatch.setattr(chat_app, 'AsyncClient', FakeEmbedClient)
+    client = chat_app.app.test_client()
+    for _ in range(2):
+        response = client.get('/messages/search?q=cat&mode=semantic')
+        assert response.status_code == 200
+        assert [r['content'] for r in response.get_json()['results']] == ['cat cat']
+
+def test_semantic_search_ranks_by_similarity(semantic):
+    history.record_message('user', 'dog dog dog', 'c1')
+    history.record_message('user', 'cat cat cat', 'c1')
+    history.record_message('assistant', 'cat and dog', 'c1')
+    embed_all()
+
+    results, _ = asyncio.run(history.semantic_search(FakeEmbedClient(), 'cat'))
+    assert [r['content'] for r in results] == ['cat cat cat', 'cat and dog', 'dog dog dog']
+    assert results[0]['score'] > results[1]['score'] > results[2]['score']
+
+    results, _ = asyncio.run(history.semantic_search(FakeEmbedClient(), 'cat', role='assistant'))
+    assert [r['content'] for r in results] == ['cat and dog']
+
+def test_semantic_search_pages_do_not_overlap(semantic):
+    for i in range(23):
+        history.record_message('user', 'cat ' * (i % 5) + 'dog ' * (i % 3))
+    embed_all()
+
+    seen, cursor = [], None
+    while True:
+        results, cursor = asyncio.run(
+            history.semantic_search(FakeEmbedClient(), 'cat', limit=5, cursor=cursor)
+        )
+        seen += [(r['score'], r['id']) for r in results]
+        if not cursor:
+            break
+    assert len(seen) == 23
+    assert len({message_id for _, message_id in seen}) == 23
+    assert seen == sorted(seen, key=lambda r: (-r[0], r[1]))
+
+def test_semantic_search_refuses_large_scans(semantic, monkeypatch):
+    monkeypatch.setattr(history, 'SEMANTIC_MAX_ROWS', 3)
+    for conversation in ('c1', 'c1', 'c2', 'c2'):
+        history.record_message('user', 'cat', conversation)
+    embed_all()
+
+    with pytest.raises(history.SearchError):
+        asyncio.run(history.semantic_search(FakeEmbedClient(), 'cat'))
+    results, _ = asyncio.run(history.semantic_search(FakeEmbedClient(), 'cat', conversation='c1'))
+    assert len(results) == 2
+
+class FlakyEmbedClient(FakeEmbedClient):
+    """Fails any call that includes a message containing 'poison'"""
+
+    def __init__(self, down=False):
+        super().__init__()
+        self.down = down
+
+    async def embed(self, model, input):
+        if self.down or any('poison' in t for t in input):
+            raise RuntimeError('embedding failed')
+        return await super().embed(model, input)
+
+def embedded_ids():
+    with history.SessionLocal() as db:
+        return {e.message_id for e in db.query(MessageEmbedding)}
+
+def test_backfill_skips_failing_messages_and_keeps_going(semantic, monkeypatch):
+    monkeypatch.setattr(history, 'EMBED_BATCH_SIZE', 4)
+    ids = [history.record_message('user', 'poison' if i == 8 else f'cat {i}').id for i in range(10)]
+
+    async def sweep(client):
+        before, sweeping = await history.backfill_step(client, None)
+        while sweeping:
+            before, sweeping = await history.backfill_step(client, before)
+    client = FlakyEmbedClient()
+    asyncio.run(sweep(client))
+    assert embedded_ids() == set(ids) - {ids[8]}
+    # The next sweep retries only the failing message, then waits for the next one
+    assert asyncio.run(history.backfill_step(client, None)) == (ids[8], False)
+    assert asyncio.run(history.backfill_step(client, ids[8])) == (None, False)
+
+def test_backfill_pauses_when_nothing_can_be_embedded(semantic, monkeypatch):
+    monkeypatch.setattr(history, 'EMBED_BATCH_SIZE', 4)
+    ids = [history.record_message('user', f'cat {i}').id for i in range(10)]
+
+    before, sweeping = asyncio.run(history.backfill_step(FlakyEmbedClient(down=True), before=None))
+    assert (before, sweeping) == (ids[6], False)
+    assert embedded_ids() == set()
+
+    # Once Ollama is back, the sweep continues below the failed batch
+    before, sweeping = asyncio.run(history.backfill_step(FakeEmbedClient(), before))
+    assert embedded_ids() == set(ids[2:6])